@@ -1,10 +1,35 @@
 from armstrong.utils.backends import GenericBackend
+from django.utils.datastructures import SortedDict
+import threading
 
 
 class BaseBackend(object):
+    """
+    Base class for the model specific backends.
+
+    ``select_related`` and ``prefetch_related`` are applied to the query
+    that an ``EventQueue`` uses to load fresh copies of the models when it
+    is flushed.  ``prefetch_related`` is ignored on versions of Django that
+    do not provide it (anything before 1.4).
+    """
+
+    select_related = ()
+    prefetch_related = ()
+
     def __init__(self, backend):
         self.backend = backend
 
+    def get_queryset(self, model):
+        """
+        Returns the ``QuerySet`` used to load ``model`` when flushing events
+        """
+        queryset = model._default_manager.all()
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related and hasattr(queryset, "prefetch_related"):
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        return queryset
+
 
 class UserBackend(BaseBackend):
     """
@@ -13,6 +38,9 @@ class UserBackend(BaseBackend):
     Each method receives a ``user`` representing the ``User`` model
     that the action was performed on.  It also receives a ``payload``
     parameter that is the ``**kwargs`` received by the signal.
+
+    Events delivered through an ``EventQueue`` only receive ``sender`` in
+    their ``payload``, plus ``created`` for ``created`` and ``updated``.
     """
 
     def created(self, user, **payload):
@@ -57,6 +85,9 @@ class GroupBackend(BaseBackend):
     Each method receives a ``group`` representing the ``Group`` model
     that the action was performed on.  It also receives a ``**payload``
     parameter that is all of the keyword arguments received by the signal.
+
+    Events delivered through an ``EventQueue`` only receive ``sender`` in
+    their ``payload``, plus ``created`` for ``created`` and ``updated``.
     """
 
     def created(self, group, **payload):
@@ -133,16 +164,168 @@ def dispatch_user_registered(sender, **kwargs):
     get_backend().user.registered(user, **kwargs)
 
 
-def activate():
+class EventQueue(object):
+    """
+    Queues ``(model, pk, event)`` triples instead of dispatching right away.
+
+    Events are collapsed as they arrive, so the queue holds at most one event
+    per object and nothing but its primary key.  When ``flush`` is called the
+    current rows are loaded with a single ``in_bulk`` query per model, and the
+    backend is called with the fresh objects.
+    """
+
+    def __init__(self):
+        self.events = SortedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum([len(pks) for pks in self.events.values()])
+
+    def push(self, model, pk, event):
+        with self.lock:
+            self.collapse(self.events, model, pk, event)
+
+    def post_save_signal(self, sender, **kwargs):
+        created = kwargs.get("created", False)
+        self.push(sender, kwargs["instance"].pk,
+                "created" if created else "updated")
+
+    def delete_signal(self, sender, **kwargs):
+        self.push(sender, kwargs["instance"].pk, "deleted")
+
+    def request_finished_signal(self, sender, **kwargs):
+        self.flush()
+
+    def collapse(self, events, model, pk, event):
+        """
+        Add ``event`` to ``events``, keeping one event per object
+
+        An object that was created and then updated is still ``created``, and
+        one that was created and then deleted is dropped.
+        """
+        pks = events.setdefault(model, SortedDict())
+        previous = pks.get(pk, None)
+        if previous == "created" and event == "updated":
+            return
+        if previous == "created" and event == "deleted":
+            del pks[pk]
+        else:
+            pks[pk] = event
+        if not pks:
+            del events[model]
+
+    def flush(self):
+        """
+        Deliver every queued event to the backend
+
+        Events that fail are put back on the queue and the first error is
+        raised once everything else has been delivered.
+        """
+        with self.lock:
+            pending, self.events = self.events, SortedDict()
+        error = None
+        try:
+            backend = get_backend()
+            for model, pks in pending.items():
+                model_backend = getattr(backend, model._meta.module_name)
+                try:
+                    failure = self.deliver(model_backend, model, pks)
+                except Exception as e:
+                    failure = e
+                error = error or failure
+        finally:
+            self.requeue(pending)
+        if error is not None:
+            raise error
+
+    def requeue(self, pending):
+        """
+        Put the undelivered events in ``pending`` back on the queue
+
+        Anything pushed while they were out takes precedence.
+        """
+        with self.lock:
+            pushed, self.events = self.events, SortedDict()
+            for events in (pending, pushed):
+                for model, pks in events.items():
+                    for pk, event in pks.items():
+                        self.collapse(self.events, model, pk, event)
+
+    def deliver(self, model_backend, model, pks):
+        """
+        Call ``model_backend`` with fresh copies of each object in ``pks``
+
+        Each pk is removed from ``pks`` once it has been delivered, so only
+        the failures are left behind.  Returns the first error raised.
+        """
+        error = None
+        objects = model_backend.get_queryset(model).in_bulk(pks.keys())
+        for pk, event in pks.items():
+            try:
+                if pk in objects:
+                    if event == "deleted":
+                        # The delete never made it to the database (it was
+                        # rolled back), so report the row as it stands.
+                        event = "updated"
+                    getattr(model_backend, event)(objects[pk], sender=model,
+                            created=event == "created")
+                elif event == "deleted":
+                    # The row is gone, so all that is left to hand over is
+                    # an unsaved instance carrying the primary key.
+                    model_backend.deleted(model(pk=pk), sender=model)
+                # Otherwise the row was deleted since the event was queued
+                # without a matching delete event being seen.
+            except Exception as e:
+                error = error or e
+                continue
+            del pks[pk]
+        return error
+
+
+event_queue = EventQueue()
+activated_queue = None
+
+
+def flush_events():
+    """
+    Flush ``event_queue`` in the current process
+    """
+    event_queue.flush()
+
+
+def activate(queue=None):
+    """
+    Connect the ``User`` and ``Group`` signals to the CRM backend
+
+    Pass a ``queue`` to queue saves and deletes instead of sending them.
+    """
+    from django.core.signals import request_finished
     from django.db.models.signals import post_delete
     from django.db.models.signals import post_save
     from django.contrib.auth.models import Group
     from django.contrib.auth.models import User
-    post_save.connect(dispatch_post_save_signal, sender=User)
-    post_save.connect(dispatch_post_save_signal, sender=Group)
-
-    post_delete.connect(dispatch_delete_signal, sender=User)
-    post_delete.connect(dispatch_delete_signal, sender=Group)
+    global activated_queue
+    previous = activated_queue
+    if previous is not None:
+        request_finished.disconnect(previous.request_finished_signal)
+    for sender in (User, Group):
+        post_save.disconnect(dispatch_post_save_signal, sender=sender)
+        post_delete.disconnect(dispatch_delete_signal, sender=sender)
+        if previous is not None:
+            post_save.disconnect(previous.post_save_signal, sender=sender)
+            post_delete.disconnect(previous.delete_signal, sender=sender)
+
+    if queue is None:
+        on_save, on_delete = dispatch_post_save_signal, dispatch_delete_signal
+    else:
+        on_save, on_delete = queue.post_save_signal, queue.delete_signal
+        request_finished.connect(queue.request_finished_signal, weak=False)
+    post_save.connect(on_save, sender=User, weak=False)
+    post_save.connect(on_save, sender=Group, weak=False)
+
+    post_delete.connect(on_delete, sender=User, weak=False)
+    post_delete.connect(on_delete, sender=Group, weak=False)
+    activated_queue = queue
 
     try:
         from registration.signals import user_activated
@@ -1,11 +1,15 @@
 from contextlib import contextmanager
 import datetime
+import gc
 from django.contrib.auth.models import Group
 from django.contrib.auth.models import User
+from django.core.signals import request_finished
+from django.db.models.signals import post_save
 from django.test.client import RequestFactory
 import fudge
 from fudge.inspector import arg
 import unittest
+import weakref
 from ._utils import TestCase
 
 try:
@@ -214,18 +218,36 @@ class get_backendTestCase(TestCase):
             self.assertIsA(b, RandomBackendForTesting)
 
 
-class ReceivingSignalsTestCase(TestCase):
+def queued_events(queue):
+    return [(model, pk, event) for model, pks in queue.events.items()
+            for pk, event in pks.items()]
+
+
+class FudgeTestCase(TestCase):
     def setUp(self):
-        super(ReceivingSignalsTestCase, self).setUp()
-        base.activate()
+        super(FudgeTestCase, self).setUp()
         fudge.clear_calls()
         fudge.clear_expectations()
-        self.factory = RequestFactory()
 
     def tearDown(self):
-        super(ReceivingSignalsTestCase, self).tearDown()
+        super(FudgeTestCase, self).tearDown()
         fudge.verify()
 
+    def expected_model(self, expected, **attrs):
+        def test(actual):
+            self.assertIsA(actual, expected)
+            for key, value in attrs.items():
+                self.assertEqual(getattr(actual, key), value)
+            return True
+        return arg.passes_test(test)
+
+
+class ReceivingSignalsTestCase(FudgeTestCase):
+    def setUp(self):
+        super(ReceivingSignalsTestCase, self).setUp()
+        base.activate()
+        self.factory = RequestFactory()
+
     def expected_payload(self, expected=None):
         def test_is_a(instance):
             def test(value):
@@ -263,12 +285,6 @@ class ReceivingSignalsTestCase(TestCase):
             del payload["created"]
         return self.expected_payload(payload)
 
-    def expected_model(self, expected):
-        def test(actual):
-            self.assertIsA(actual, expected)
-            return True
-        return arg.passes_test(test)
-
     def expected_user_model(self):
         return self.expected_model(User)
 
@@ -363,3 +379,273 @@ class ReceivingSignalsTestCase(TestCase):
         with fudge.patched_context(base.UserBackend, "registered", registered):
             r.register(request, username="bob", email="bob@example.com",
                     password1="foobar")
+
+
+class EventQueueTestCase(FudgeTestCase):
+    def setUp(self):
+        super(EventQueueTestCase, self).setUp()
+        self.queue = base.EventQueue()
+
+    def flush(self):
+        with self.settings(ARMSTRONG_CRM_BACKEND="%s.Backend" %
+                base.__name__):
+            self.queue.flush()
+
+    def test_only_stores_model_pk_and_event(self):
+        u = User.objects.create(username="foobar")
+        self.queue.post_save_signal(User, instance=u, created=True)
+        self.assertEqual(queued_events(self.queue), [(User, u.pk, "created")])
+
+    def test_delete_signal_queues_deleted_event(self):
+        g = Group.objects.create(name="foobar")
+        self.queue.delete_signal(Group, instance=g)
+        self.assertEqual(queued_events(self.queue),
+                [(Group, g.pk, "deleted")])
+
+    def test_collapses_to_latest_event_per_pk(self):
+        self.queue.push(User, 1, "updated")
+        self.queue.push(User, 2, "updated")
+        self.queue.push(User, 1, "deleted")
+        self.assertEqual(queued_events(self.queue),
+                [(User, 1, "deleted"), (User, 2, "updated")])
+
+    def test_created_then_updated_collapses_to_created(self):
+        self.queue.push(User, 1, "created")
+        self.queue.push(User, 1, "updated")
+        self.assertEqual(queued_events(self.queue), [(User, 1, "created")])
+
+    def test_created_then_deleted_is_dropped(self):
+        self.queue.push(User, 1, "created")
+        self.queue.push(User, 1, "deleted")
+        self.assertEqual(queued_events(self.queue), [])
+
+    def test_holds_one_event_per_object(self):
+        for i in range(100):
+            self.queue.push(User, 1, "updated")
+            self.queue.push(Group, 1, "updated")
+        self.assertEqual(len(self.queue), 2)
+
+    def test_flush_empties_the_queue(self):
+        self.queue.push(User, 1, "deleted")
+        self.flush()
+        self.assertEqual(len(self.queue), 0)
+
+    def test_flush_sends_current_state(self):
+        u = User.objects.create(username="foobar")
+        self.queue.push(User, u.pk, "updated")
+        User.objects.filter(pk=u.pk).update(username="foobar-modified")
+
+        fake_update = fudge.Fake()
+        fake_update.is_callable().expects_call().with_args(
+                self.expected_model(User, username="foobar-modified"), sender=User,
+                created=False)
+        with fudge.patched_context(base.UserBackend, "updated", fake_update):
+            self.flush()
+
+    def test_flush_sends_created_events(self):
+        u = User.objects.create(username="foobar")
+        self.queue.push(User, u.pk, "created")
+
+        fake_create = fudge.Fake()
+        fake_create.is_callable().expects_call().with_args(
+                self.expected_model(User, username="foobar"), sender=User,
+                created=True)
+        with fudge.patched_context(base.UserBackend, "created", fake_create):
+            self.flush()
+
+    def test_flush_sends_group_updates(self):
+        g = Group.objects.create(name="foobar")
+        self.queue.push(Group, g.pk, "updated")
+        Group.objects.filter(pk=g.pk).update(name="foobar-modified")
+
+        fake_update = fudge.Fake()
+        fake_update.is_callable().expects_call().with_args(
+                self.expected_model(Group, name="foobar-modified"),
+                sender=Group, created=False)
+        with fudge.patched_context(base.GroupBackend, "updated", fake_update):
+            self.flush()
+
+    def test_flush_loads_each_model_with_one_query(self):
+        users = [User.objects.create(username="user-%d" % i)
+                for i in range(3)]
+        for user in users:
+            self.queue.push(User, user.pk, "updated")
+
+        fake_update = fudge.Fake()
+        fake_update.is_callable().expects_call().times_called(3)
+        with fudge.patched_context(base.UserBackend, "updated", fake_update):
+            self.assertNumQueries(1, self.flush)
+
+    def test_flush_skips_rows_that_no_longer_exist(self):
+        u = User.objects.create(username="foobar")
+        self.queue.push(User, u.pk, "updated")
+        User.objects.filter(pk=u.pk).delete()
+
+        fake_update = fudge.Fake()
+        fake_update.is_callable().times_called(0)
+        with fudge.patched_context(base.UserBackend, "updated", fake_update):
+            self.flush()
+
+    def test_flush_sends_deleted_with_pk_only_instance(self):
+        self.queue.push(Group, 123, "deleted")
+        fake_deleted = fudge.Fake()
+        fake_deleted.is_callable().expects_call().with_args(
+                self.expected_model(Group, pk=123), sender=Group)
+        with fudge.patched_context(base.GroupBackend, "deleted", fake_deleted):
+            self.flush()
+
+    def test_flush_sends_deleted_rows_that_still_exist_as_updated(self):
+        g = Group.objects.create(name="foobar")
+        self.queue.push(Group, g.pk, "deleted")
+
+        fake_deleted = fudge.Fake()
+        fake_deleted.is_callable().times_called(0)
+        fake_update = fudge.Fake()
+        fake_update.is_callable().expects_call().with_args(
+                self.expected_model(Group, pk=g.pk), sender=Group,
+                created=False)
+        with fudge.patched_context(base.GroupBackend, "deleted", fake_deleted):
+            with fudge.patched_context(base.GroupBackend, "updated",
+                    fake_update):
+                self.flush()
+
+    def test_get_queryset_applies_select_related(self):
+        class MyUserBackend(base.UserBackend):
+            select_related = ("foo", )
+
+        queryset = MyUserBackend(object()).get_queryset(User)
+        self.assertEqual(queryset.query.select_related, {"foo": {}})
+
+    def test_get_queryset_applies_prefetch_related_when_available(self):
+        class MyUserBackend(base.UserBackend):
+            prefetch_related = ("groups", )
+
+        queryset = fudge.Fake()
+        queryset.expects("prefetch_related").with_args("groups") \
+                .returns(queryset)
+        manager = fudge.Fake().expects("all").returns(queryset)
+        model = fudge.Fake().has_attr(_default_manager=manager)
+        self.assertEqual(MyUserBackend(object()).get_queryset(model),
+                queryset)
+
+    def test_get_queryset_ignores_prefetch_related_when_unavailable(self):
+        class MyUserBackend(base.UserBackend):
+            prefetch_related = ("groups", )
+
+        queryset = fudge.Fake()
+        manager = fudge.Fake().expects("all").returns(queryset)
+        model = fudge.Fake().has_attr(_default_manager=manager)
+        self.assertEqual(MyUserBackend(object()).get_queryset(model),
+                queryset)
+
+    def test_flush_requeues_only_the_events_that_raise(self):
+        users = [User.objects.create(username="user-%d" % i)
+                for i in range(3)]
+        for user in users:
+            self.queue.push(User, user.pk, "updated")
+
+        class BackendError(Exception):
+            pass
+
+        fake_update = fudge.Fake()
+        fake_update.is_callable().expects_call().next_call() \
+                .raises(BackendError()).next_call()
+        with fudge.patched_context(base.UserBackend, "updated", fake_update):
+            self.assertRaises(BackendError, self.flush)
+        self.assertEqual(queued_events(self.queue),
+                [(User, users[1].pk, "updated")])
+
+    def test_flush_keeps_events_pushed_while_it_fails(self):
+        u = User.objects.create(username="foobar")
+        g = Group.objects.create(name="foobar")
+        self.queue.push(User, u.pk, "updated")
+
+        class BackendError(Exception):
+            pass
+
+        def updated(user_backend, user, **payload):
+            self.queue.push(Group, g.pk, "updated")
+            self.queue.push(User, u.pk, "deleted")
+            raise BackendError()
+
+        with fudge.patched_context(base.UserBackend, "updated", updated):
+            self.assertRaises(BackendError, self.flush)
+        self.assertEqual(queued_events(self.queue),
+                [(User, u.pk, "deleted"), (Group, g.pk, "updated")])
+
+
+class ActivateWithQueueTestCase(FudgeTestCase):
+    def setUp(self):
+        super(ActivateWithQueueTestCase, self).setUp()
+        self.queue = base.EventQueue()
+
+    def tearDown(self):
+        base.activate()
+        super(ActivateWithQueueTestCase, self).tearDown()
+
+    def test_saves_are_queued_instead_of_dispatched(self):
+        base.activate()
+        base.activate(queue=self.queue)
+        fake_create = fudge.Fake()
+        fake_create.is_callable().times_called(0)
+        with fudge.patched_context(base.UserBackend, "created", fake_create):
+            u = User.objects.create(username="foobar")
+        self.assertEqual(queued_events(self.queue), [(User, u.pk, "created")])
+
+    def test_deletes_are_queued_instead_of_dispatched(self):
+        g = Group.objects.create(name="foobar")
+        pk = g.pk
+        base.activate(queue=self.queue)
+        fake_deleted = fudge.Fake()
+        fake_deleted.is_callable().times_called(0)
+        with fudge.patched_context(base.GroupBackend, "deleted", fake_deleted):
+            g.delete()
+        self.assertEqual(queued_events(self.queue), [(Group, pk, "deleted")])
+
+    def test_queue_is_flushed_when_the_request_finishes(self):
+        base.activate(queue=self.queue)
+        u = User.objects.create(username="foobar")
+
+        fake_create = fudge.Fake()
+        fake_create.is_callable().expects_call().with_args(
+                self.expected_model(User, pk=u.pk), sender=User, created=True)
+        with fudge.patched_context(base.UserBackend, "created", fake_create):
+            with self.settings(ARMSTRONG_CRM_BACKEND="%s.Backend" %
+                    base.__name__):
+                request_finished.send(sender=self.__class__)
+        self.assertEqual(len(self.queue), 0)
+
+    def test_request_finished_is_disconnected_without_a_queue(self):
+        base.activate(queue=self.queue)
+        base.activate()
+        self.queue.push(User, 1, "deleted")
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(len(self.queue), 1)
+
+    def test_activating_again_replaces_the_queue(self):
+        base.activate(queue=self.queue)
+        base.activate()
+        fake_create = fudge.Fake()
+        fake_create.is_callable().expects_call().times_called(1)
+        with fudge.patched_context(base.UserBackend, "created", fake_create):
+            User.objects.create(username="foobar")
+        self.assertEqual(len(self.queue), 0)
+
+    def test_receivers_can_still_be_disconnected_by_function(self):
+        base.activate()
+        post_save.disconnect(base.dispatch_post_save_signal, sender=User)
+        fake_create = fudge.Fake()
+        fake_create.is_callable().times_called(0)
+        with fudge.patched_context(base.UserBackend, "created", fake_create):
+            User.objects.create(username="foobar")
+
+    def test_queue_stays_connected_without_other_references(self):
+        queue = base.EventQueue()
+        queue_ref = weakref.ref(queue)
+        base.activate(queue=queue)
+        del queue
+        gc.collect()
+        u = User.objects.create(username="foobar")
+        self.assertTrue(queue_ref() is not None)
+        self.assertEqual(queued_events(queue_ref()),
+                [(User, u.pk, "created")])